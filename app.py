@@ -1,7 +1,12 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, abort, session
+from flask import Flask, render_template, request, redirect, url_for, flash, abort, session, make_response
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
+from sqlalchemy import event, func, insert, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import load_only, selectinload
+import heapq
 import os
+from functools import lru_cache, partial, wraps
+from itertools import groupby
 from datetime import datetime
 from pathlib import Path
 
@@ -21,21 +26,85 @@ ADMIN_PASSWORD = os.environ.get("ADMIN_PASSWORD", "admin123")
 
 db = SQLAlchemy(app)
 
+# --- PRAGMAs de SQLite en cada conexión: WAL + synchronous=NORMAL abaratan cada commit;
+#     foreign_keys=ON activa el ON DELETE CASCADE de game_result ---
+def set_sqlite_pragmas(dbapi_conn, _record):
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA foreign_keys=ON")
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA cache_size=-20000")  # ~20 MB
+    cur.close()
+
 # --- bootstrap de esquema: añade 'active' si falta (SQLite) ---
 with app.app_context():
-    from sqlalchemy import inspect, text
+    from sqlalchemy import inspect
+    event.listen(db.engine, "connect", set_sqlite_pragmas)
     insp = inspect(db.engine)
     cols = [c["name"] for c in insp.get_columns("player")]
     if "active" not in cols:
         db.session.execute(text("ALTER TABLE player ADD COLUMN active BOOLEAN NOT NULL DEFAULT 1"))
         db.session.commit()
 
+    # 'has_winner' precalculado en Game (antes se deducía de los resultados en cada carga)
+    cols = [c["name"] for c in insp.get_columns("game")]
+    if "has_winner" not in cols:
+        db.session.execute(text("ALTER TABLE game ADD COLUMN has_winner BOOLEAN NOT NULL DEFAULT 0"))
+        db.session.execute(text(
+            "UPDATE game SET has_winner = (COALESCE(sweep, 0) = 1 OR EXISTS "
+            "(SELECT 1 FROM game_result gr WHERE gr.game_id = game.id AND gr.position = 1))"
+        ))
+        db.session.commit()
+
+    # game_result.game_id con ON DELETE CASCADE: SQLite no altera FKs, hay que reconstruir la tabla
+    game_fk = next(fk for fk in insp.get_foreign_keys("game_result") if fk["referred_table"] == "game")
+    if (game_fk["options"].get("ondelete") or "").upper() != "CASCADE":
+        # un solo BEGIN ... COMMIT: si el proceso muere a medias no queda 'game_result_new' colgada
+        with db.engine.connect() as conn:
+            conn.connection.driver_connection.executescript("""
+                BEGIN IMMEDIATE;
+                DROP TABLE IF EXISTS game_result_new;
+                CREATE TABLE game_result_new (
+                    id INTEGER NOT NULL,
+                    game_id INTEGER NOT NULL,
+                    player_id INTEGER NOT NULL,
+                    position INTEGER,
+                    PRIMARY KEY (id),
+                    FOREIGN KEY(game_id) REFERENCES game (id) ON DELETE CASCADE,
+                    FOREIGN KEY(player_id) REFERENCES player (id)
+                );
+                -- se descartan resultados huérfanos (mesa ya borrada)
+                INSERT INTO game_result_new (id, game_id, player_id, position)
+                    SELECT id, game_id, player_id, position FROM game_result
+                    WHERE game_id IN (SELECT id FROM game);
+                DROP TABLE game_result;
+                ALTER TABLE game_result_new RENAME TO game_result;
+                COMMIT;
+            """)
+
+    # índices de filtros/joins (BD creadas antes de declararlos en los modelos)
+    for ddl in (
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_player_name_lower ON player (lower(name))",
+        "CREATE INDEX IF NOT EXISTS ix_game_round_table ON game (round_number, table_no)",
+        "CREATE INDEX IF NOT EXISTS ix_game_save_player ON game (save_player_id)",
+        "CREATE INDEX IF NOT EXISTS ix_game_has_winner ON game (has_winner)",
+        "CREATE INDEX IF NOT EXISTS ix_gr_game_player ON game_result (game_id, player_id)",
+        "CREATE INDEX IF NOT EXISTS ix_gr_player ON game_result (player_id)",
+        "CREATE INDEX IF NOT EXISTS ix_ri_bye_player ON round_info (bye_player_id)",
+    ):
+        db.session.execute(text(ddl))
+    db.session.commit()
+
 # ---------- MODELOS ----------
 class Player(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, unique=True, nullable=False)
     active = db.Column(db.Boolean, nullable=False, default=True)
 
+    # nombre único sin distinguir mayúsculas (también acelera la búsqueda por lower(name))
+    __table_args__ = (db.Index("ix_player_name_lower", func.lower(name), unique=True),)
+
 class RoundInfo(db.Model):
     """Información por ronda (por ahora, solo 'descanso')."""
     id = db.Column(db.Integer, primary_key=True)
@@ -44,6 +113,8 @@ class RoundInfo(db.Model):
     bye_player = db.relationship("Player", foreign_keys=[bye_player_id])
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (db.Index("ix_ri_bye_player", "bye_player_id"),)
+
 class Game(db.Model):
     """Partida/mesa."""
     id = db.Column(db.Integer, primary_key=True)
@@ -51,40 +122,63 @@ class Game(db.Model):
     table_no = db.Column(db.Integer, nullable=False)
     banned_card = db.Column(db.String, nullable=True)
     sweep = db.Column(db.Boolean, default=False)  # barrida: solo el 1º puntúa (3)
+    has_winner = db.Column(db.Boolean, nullable=False, default=False, index=True)  # pos=1 asignada o barrida
     save_player_id = db.Column(db.Integer, db.ForeignKey("player.id"), nullable=True)
     save_player = db.relationship("Player", foreign_keys=[save_player_id])
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        db.Index("ix_game_round_table", "round_number", "table_no"),
+        db.Index("ix_game_save_player", "save_player_id"),
+    )
+
 class GameResult(db.Model):
     """Resultado por jugador en una partida."""
     id = db.Column(db.Integer, primary_key=True)
-    game_id = db.Column(db.Integer, db.ForeignKey("game.id"), nullable=False)
+    game_id = db.Column(db.Integer, db.ForeignKey("game.id", ondelete="CASCADE"), nullable=False)
     player_id = db.Column(db.Integer, db.ForeignKey("player.id"), nullable=False)
     position = db.Column(db.Integer, nullable=True)  # 1=ganador, 2=segundo, 3=tercero; None si sin posición
-    game = db.relationship("Game", backref=db.backref("results", lazy=True, cascade="all, delete-orphan"))
+    game = db.relationship("Game", backref=db.backref("results", lazy=True, cascade="all, delete-orphan",
+                                                      passive_deletes=True, order_by="GameResult.id"))
     player = db.relationship("Player")
 
+    __table_args__ = (
+        db.Index("ix_gr_game_player", "game_id", "player_id"),
+        db.Index("ix_gr_player", "player_id"),
+    )
+
+class Leaderboard(db.Model):
+    """Clasificación materializada: una fila por jugador, recalculada en cada escritura."""
+    player_id = db.Column(db.Integer, db.ForeignKey("player.id"), primary_key=True)
+    points = db.Column(db.Integer, nullable=False, default=0)
+    wins = db.Column(db.Integer, nullable=False, default=0)
+    seconds = db.Column(db.Integer, nullable=False, default=0)
+    thirds = db.Column(db.Integer, nullable=False, default=0)
+    saves = db.Column(db.Integer, nullable=False, default=0)   # salvavidas
+    played = db.Column(db.Integer, nullable=False, default=0)  # rondas con mesa ya resuelta
+    rests = db.Column(db.Integer, nullable=False, default=0)   # descansos asignados
+
+class TournamentState(db.Model):
+    """Fila única (id=1) con la versión del torneo; sube en cada escritura e invalida las cachés."""
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
 # ---------- REGLAS DE PUNTUACIÓN ----------
-def points_for_position(position: int, sweep: bool) -> int:
-    if position is None:
-        return 0
-    if sweep:
-        return 3 if position == 1 else 0
-    if position == 1:
-        return 3
-    if position == 2:
-        return 2
-    if position == 3:
-        return 1
-    return 0
+# (barrida, posición) -> puntos; cualquier otra combinación (sin posición, 2º/3º en barrida) suma 0
+POINTS = {
+    (False, 1): 3,
+    (False, 2): 2,
+    (False, 3): 1,
+    (True, 1): 3,
+}
 
 # ---------- SEED JUGADORES ----------
 def seed_players():
     names = ["Borux", "Negro", "Gueta", "Teran", "Mauro", "Gordor", "Xephi", "Omar", "Richard"]
     for n in names:
-        if not Player.query.filter_by(name=n).first():
+        if db.session.query(Player.id).filter_by(name=n).scalar() is None:
             db.session.add(Player(name=n))
-    db.session.commit()
+    commit_changes()
 
 # ---------- IMPORTADOR DE TUS RONDAS ----------
 NAME_FIX = {
@@ -92,34 +186,35 @@ NAME_FIX = {
     "Xephy": "Xephi",
 }
 
-def get_or_create_player(name: str) -> Player:
+def get_or_create_player(name: str, name_map: dict) -> Player:
+    """Busca en el mapa nombre -> Player precargado; crea (y registra) el jugador si falta."""
     norm = NAME_FIX.get(name, name)
-    p = Player.query.filter_by(name=norm).first()
-    if p:
-        return p
     # si no existe el normalizado, intenta con el original
-    p = Player.query.filter_by(name=name).first()
+    p = name_map.get(norm) or name_map.get(name)
     if p:
         return p
     p = Player(name=norm)
     db.session.add(p)
     db.session.flush()
+    name_map[norm] = p
     return p
 
-def add_game(round_no, table_no, players, winner=None, second=None, third=None, banned=None, bye=None):
-    """Crea RoundInfo (si bye), Game y GameResult. second/third pueden ser None."""
+def add_game(round_no, table_no, players, winner=None, second=None, third=None, banned=None, bye=None,
+             *, name_map, new_results):
+    """Crea RoundInfo (si bye) y Game; deja las filas de GameResult en new_results. second/third pueden ser None."""
     # RoundInfo (bye)
-    ri = RoundInfo.query.filter_by(number=round_no).first()
+    ri = RoundInfo.query.options(load_only(RoundInfo.id)).filter_by(number=round_no).first()
     if not ri:
         ri = RoundInfo(number=round_no)
         db.session.add(ri)
         db.session.flush()
     if bye:
-        ri.bye_player_id = get_or_create_player(bye).id
+        ri.bye_player_id = get_or_create_player(bye, name_map).id
 
     g = Game(round_number=round_no, table_no=table_no, banned_card=banned or None)
     # 'sweep' si hay ganador y NO hay segundo ni tercero
     g.sweep = bool(winner and (second is None) and (third is None))
+    g.has_winner = bool(winner)
     db.session.add(g)
     db.session.flush()
 
@@ -130,145 +225,191 @@ def add_game(round_no, table_no, players, winner=None, second=None, third=None,
     if third:  positions[third]  = 3
 
     for name in players:
-        pid = get_or_create_player(name).id
+        pid = get_or_create_player(name, name_map).id
         pos = positions.get(name)
-        db.session.add(GameResult(game_id=g.id, player_id=pid, position=pos))
+        new_results.append({"game_id": g.id, "player_id": pid, "position": pos})
 
 def import_initial_rounds():
     """Importa tus 9 rondas tal como las pasaste. Se ejecuta una sola vez si no hay partidas."""
     if Game.query.count() > 0:
         return  # ya importado o ya hay partidas
 
+    # Jugadores precargados en memoria y resultados insertados en bloque al final
+    name_map = {p.name: p for p in Player.query.all()}
+    new_results = []
+    add = partial(add_game, name_map=name_map, new_results=new_results)
+
     # RONDA 1
-    add_game(1, 1, ["Negro","Mauro","Xephy","Omar"], winner="Negro", second="Omar",
-             banned="Mondrak, Glory Dominus", bye="Goldor")
-    add_game(1, 2, ["Richard","Gueta","Teran","Borux"], winner="Gueta",
-             banned="Conduit of Worlds")
+    add(1, 1, ["Negro","Mauro","Xephy","Omar"], winner="Negro", second="Omar",
+        banned="Mondrak, Glory Dominus", bye="Goldor")
+    add(1, 2, ["Richard","Gueta","Teran","Borux"], winner="Gueta",
+        banned="Conduit of Worlds")
 
     # RONDA 2
-    add_game(2, 1, ["Negro","Xephy","Richard","Gueta"], bye="Mauro")  # sin resultados aún
-    add_game(2, 2, ["Omar","Borux","Goldor","Teran"], winner="Goldor", second="Teran", third="Omar",
-             banned="Kotori, Pilot Prodigy")
+    add(2, 1, ["Negro","Xephy","Richard","Gueta"], bye="Mauro")  # sin resultados aún
+    add(2, 2, ["Omar","Borux","Goldor","Teran"], winner="Goldor", second="Teran", third="Omar",
+        banned="Kotori, Pilot Prodigy")
 
     # RONDA 3
-    add_game(3, 1, ["Negro","Mauro","Borux","Goldor"], winner="Negro", second="Borux", third="Goldor",
-             banned="Peregrim took", bye="Xephy")
-    add_game(3, 2, ["Omar","Richard","Gueta","Teran"])  # sin resultados
+    add(3, 1, ["Negro","Mauro","Borux","Goldor"], winner="Negro", second="Borux", third="Goldor",
+        banned="Peregrim took", bye="Xephy")
+    add(3, 2, ["Omar","Richard","Gueta","Teran"])  # sin resultados
 
     # RONDA 4
-    add_game(4, 1, ["Negro","Gueta","Richard","Borux"], winner="Gueta", second="Borux", third="Richard",
-             banned="Bastion of Remembrance", bye="Omar")
-    add_game(4, 2, ["Mauro","Xephy","Goldor","Teran"])  # sin resultados
+    add(4, 1, ["Negro","Gueta","Richard","Borux"], winner="Gueta", second="Borux", third="Richard",
+        banned="Bastion of Remembrance", bye="Omar")
+    add(4, 2, ["Mauro","Xephy","Goldor","Teran"])  # sin resultados
 
     # RONDA 5
-    add_game(5, 1, ["Negro","Omar","Borux","Goldor"], bye="Richard")
-    add_game(5, 2, ["Mauro","Xephy","Gueta","Teran"])
+    add(5, 1, ["Negro","Omar","Borux","Goldor"], bye="Richard")
+    add(5, 2, ["Mauro","Xephy","Gueta","Teran"])
 
     # RONDA 6
-    add_game(6, 1, ["Gueta","Xephy","Richard","Goldor"], bye="Negro")
-    add_game(6, 2, ["Mauro","Omar","Borux","Teran"])
+    add(6, 1, ["Gueta","Xephy","Richard","Goldor"], bye="Negro")
+    add(6, 2, ["Mauro","Omar","Borux","Teran"])
 
     # RONDA 7
-    add_game(7, 1, ["Negro","Xephy","Omar","Borux"], bye="Teran")
-    add_game(7, 2, ["Mauro","Richard","Gueta","Goldor"])
+    add(7, 1, ["Negro","Xephy","Omar","Borux"], bye="Teran")
+    add(7, 2, ["Mauro","Richard","Gueta","Goldor"])
 
     # RONDA 8
-    add_game(8, 1, ["Negro","Mauro","Gueta","Teran"], bye="Borux")
-    add_game(8, 2, ["Xephy","Omar","Richard","Goldor"])
+    add(8, 1, ["Negro","Mauro","Gueta","Teran"], bye="Borux")
+    add(8, 2, ["Xephy","Omar","Richard","Goldor"])
 
     # RONDA 9
-    add_game(9, 1, ["Goldor","Mauro","Omar","Richard"], bye="Gueta")
-    add_game(9, 2, ["Xephy","Negro","Teran","Borux"], winner="Teran", second="Borux", third="Xephy",
-             banned="Ureni of the Unwriten")
-
-    db.session.commit()
-
-# ---------- CLASIFICACIÓN ----------
-@app.route("/")
-def index():
-    players = Player.query.filter_by(active=True).order_by(Player.name.asc()).all()
-
-    # Totales (medallero + salvavidas)
-    totals = {
-        p.id: {"name": p.name, "points": 0, "wins": 0, "seconds": 0, "thirds": 0, "saves": 0}
-        for p in players
-    }
-
-    from collections import defaultdict
-    played_rounds = defaultdict(set)    # player_id -> rondas YA jugadas (mesa con ganador o barrida)
-    rests_by_player = defaultdict(int)  # descansos asignados
-    all_rounds = set()                  # rondas planificadas (por Game o RoundInfo)
+    add(9, 1, ["Goldor","Mauro","Omar","Richard"], bye="Gueta")
+    add(9, 2, ["Xephy","Negro","Teran","Borux"], winner="Teran", second="Borux", third="Xephy",
+        banned="Ureni of the Unwriten")
+
+    db.session.execute(insert(GameResult.__table__), new_results)
+    commit_changes()
+
+# ---------- CLASIFICACIÓN MATERIALIZADA ----------
+# CASE de puntos por resultado, generado a partir de POINTS (una sola fuente de reglas)
+POINTS_CASE = "CASE " + " ".join(
+    f"WHEN COALESCE(g.sweep, 0) = {int(sweep)} AND gr.position = {pos} THEN {pts}"
+    for (sweep, pos), pts in POINTS.items()
+) + " ELSE 0 END"
+
+PODIUM_SQL = f"""
+    SELECT gr.player_id,
+           SUM({POINTS_CASE}) AS points,
+           SUM(CASE WHEN gr.position = 1 THEN 1 ELSE 0 END) AS wins,
+           SUM(CASE WHEN gr.position = 2 THEN 1 ELSE 0 END) AS seconds,
+           SUM(CASE WHEN gr.position = 3 THEN 1 ELSE 0 END) AS thirds
+    FROM game_result gr JOIN game g ON g.id = gr.game_id
+    GROUP BY gr.player_id
+"""
+
+SAVES_SQL = """
+    SELECT save_player_id AS player_id, COUNT(*) AS saves FROM game
+    WHERE save_player_id IS NOT NULL
+    GROUP BY save_player_id
+"""
+
+# Una ronda cuenta como jugada si la mesa tiene ganador (pos=1) o es barrida
+PLAYED_SQL = """
+    SELECT gr.player_id, COUNT(DISTINCT g.round_number) AS played
+    FROM game_result gr JOIN game g ON g.id = gr.game_id
+    WHERE g.has_winner = 1
+    GROUP BY gr.player_id
+"""
+
+RESTS_SQL = """
+    SELECT bye_player_id AS player_id, COUNT(*) AS rests FROM round_info
+    WHERE bye_player_id IS NOT NULL
+    GROUP BY bye_player_id
+"""
+
+# Una fila por jugador; el salvavidas suma +1 punto además de su contador
+LEADERBOARD_SQL = f"""
+    INSERT INTO leaderboard (player_id, points, wins, seconds, thirds, saves, played, rests)
+    SELECT p.id,
+           COALESCE(pod.points, 0) + COALESCE(sv.saves, 0),
+           COALESCE(pod.wins, 0), COALESCE(pod.seconds, 0), COALESCE(pod.thirds, 0),
+           COALESCE(sv.saves, 0), COALESCE(pl.played, 0), COALESCE(rs.rests, 0)
+    FROM player p
+    LEFT JOIN ({PODIUM_SQL}) pod ON pod.player_id = p.id
+    LEFT JOIN ({SAVES_SQL}) sv ON sv.player_id = p.id
+    LEFT JOIN ({PLAYED_SQL}) pl ON pl.player_id = p.id
+    LEFT JOIN ({RESTS_SQL}) rs ON rs.player_id = p.id
+"""
+
+ROUNDS_SQL = "SELECT COUNT(*) FROM (SELECT number FROM round_info UNION SELECT round_number FROM game)"
+
+def refresh_leaderboard():
+    """Recalcula la tabla 'leaderboard' dentro de la transacción en curso."""
+    db.session.flush()
+    db.session.execute(text("DELETE FROM leaderboard"))
+    db.session.execute(text(LEADERBOARD_SQL))
 
-    # Descansos (planificados)
-    for ri in RoundInfo.query.all():
-        all_rounds.add(ri.number)
-        if ri.bye_player_id:
-            rests_by_player[ri.bye_player_id] += 1
+def tournament_version() -> int:
+    """Versión del torneo guardada en la BD: la comparten todos los procesos que usan torneo.db."""
+    return db.session.execute(text("SELECT version FROM tournament_state WHERE id = 1")).scalar()
 
-    # Mesas
-    games = Game.query.order_by(Game.round_number.asc(), Game.table_no.asc()).all()
-    for g in games:
-        all_rounds.add(g.round_number)
-
-        # Salvavidas: +1 punto y +1 contador
-        if g.save_player_id and g.save_player_id in totals:
-            totals[g.save_player_id]["points"] += 1
-            totals[g.save_player_id]["saves"] += 1
+def commit_changes():
+    """Recalcula la clasificación y sube la versión del torneo en la misma transacción."""
+    refresh_leaderboard()
+    db.session.execute(text("UPDATE tournament_state SET version = version + 1 WHERE id = 1"))
+    db.session.commit()
 
-        # ¿Mesa con ganador? (pos=1 o barrida)
-        has_winner = any(r.position == 1 for r in g.results) or bool(g.sweep)
+# ---------- ACCESO ADMIN ----------
+def admin_required(view):
+    """Redirige a la clasificación con aviso si la sesión no es de admin."""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if not session.get("is_admin"):
+            flash("No autorizado.", "danger")
+            return redirect(url_for("index"))
+        return view(*args, **kwargs)
+    return wrapped
 
-        # Pódium y jugadas
-        for r in g.results:
-            pts = points_for_position(r.position, g.sweep)
-            totals[r.player_id]["points"] += pts
-            if r.position == 1:
-                totals[r.player_id]["wins"] += 1
-            elif r.position == 2:
-                totals[r.player_id]["seconds"] += 1
-            elif r.position == 3:
-                totals[r.player_id]["thirds"] += 1
-            # Si la mesa tiene ganador, cuenta como jugada
-            if has_winner:
-                played_rounds[r.player_id].add(g.round_number)
-
-    total_rounds = len(all_rounds)
+# ---------- CLASIFICACIÓN ----------
+@lru_cache(maxsize=4)
+def classification_data(version: int):
+    """Tabla, participación y nº de rondas; se recalcula solo cuando cambia la versión del torneo."""
+    rows = (db.session.query(Player.id, Player.name, Leaderboard)
+            .join(Leaderboard, Leaderboard.player_id == Player.id)
+            .filter(Player.active.is_(True))
+            .order_by(Player.name.asc())
+            .all())
+    total_rounds = db.session.execute(text(ROUNDS_SQL)).scalar()  # rondas planificadas (Game o RoundInfo)
 
     # Participación y límites de puntos
     per_player = {}
-    for p in players:
-        played = len(played_rounds[p.id])
-        rests = rests_by_player[p.id]
-        planned_to_play = max(total_rounds - rests, 0)    # partidas que le corresponden
-        remaining = max(planned_to_play - played, 0)      # le faltan por jugar
-        lb = totals[p.id]["points"]                       # mínimo: lo que ya tiene
-        ub = lb + 4 * remaining                           # máximo: 4 por partida restante
-
-        per_player[p.id] = {
-            "name": p.name,
-            "points": totals[p.id]["points"],
-            "wins": totals[p.id]["wins"],
-            "seconds": totals[p.id]["seconds"],
-            "thirds": totals[p.id]["thirds"],
-            "saves": totals[p.id]["saves"],
-            "played": played,
-            "rests": rests,
+    for pid, name, board in rows:
+        planned_to_play = max(total_rounds - board.rests, 0)    # partidas que le corresponden
+        remaining = max(planned_to_play - board.played, 0)      # le faltan por jugar
+        lb = board.points                                       # mínimo: lo que ya tiene
+        ub = lb + 4 * remaining                                 # máximo: 4 por partida restante
+
+        per_player[pid] = {
+            "name": name,
+            "points": board.points,
+            "wins": board.wins,
+            "seconds": board.seconds,
+            "thirds": board.thirds,
+            "saves": board.saves,
+            "played": board.played,
+            "rests": board.rests,
             "planned_to_play": planned_to_play,
             "remaining": remaining,
             "lb": lb,
             "ub": ub,
         }
 
-    # Etiquetas de CLASIFICADO / ELIMINADO (criterio conservador por puntos)
+    # Etiquetas de CLASIFICADO / ELIMINADO (criterio conservador por puntos), tabla principal
+    # y participación (jugadas/pendientes) en una sola pasada; per_player ya viene ordenado por nombre
     ids = list(per_player.keys())
+    # Top-5 global de mínimos/máximos: excluido uno mismo, quedan siempre los 4 mejores rivales
+    top_LBs = heapq.nlargest(5, ((per_player[q]["lb"], q) for q in ids))
+    top_UBs = heapq.nlargest(5, ((per_player[q]["ub"], q) for q in ids))
+    table, participation = [], []
     for pid in ids:
         me = per_player[pid]
-        # rivales
-        rival_LBs = sorted([per_player[q]["lb"] for q in ids if q != pid], reverse=True)
-        rival_UBs = sorted([per_player[q]["ub"] for q in ids if q != pid], reverse=True)
         # 4º mejor rival (índice 3)
-        fourth_best_rival_LB = rival_LBs[3]
-        fourth_best_rival_UB = rival_UBs[3]
+        fourth_best_rival_LB = [v for v, q in top_LBs if q != pid][3]
+        fourth_best_rival_UB = [v for v, q in top_UBs if q != pid][3]
 
         status = None
         # Clinched: ni en el peor caso puede caer del top-4
@@ -278,77 +419,80 @@ def index():
         elif me["ub"] < fourth_best_rival_LB:
             status = "ELIMINADO"
 
-        me["status"] = status
-
-    # Construye tabla principal (orden medallero: puntos → 1º → 2º → 3º → nombre)
-    table = []
-    for pid, row in per_player.items():
         table.append({
             "id": pid,
-            "name": row["name"],
-            "points": row["points"],
-            "wins": row["wins"],
-            "seconds": row["seconds"],
-            "thirds": row["thirds"],
-            "saves": row["saves"],
-            "status": row["status"],
+            "name": me["name"],
+            "points": me["points"],
+            "wins": me["wins"],
+            "seconds": me["seconds"],
+            "thirds": me["thirds"],
+            "saves": me["saves"],
+            "status": status,
+        })
+        participation.append({
+            "name": me["name"],
+            "played": me["played"],
+            "remaining": me["remaining"],
+            "rests": me["rests"],
+            "planned_to_play": me["planned_to_play"],
         })
 
-    table.sort(key=lambda x: x["name"])
-    table.sort(key=lambda x: (x["points"], x["wins"], x["seconds"], x["thirds"]), reverse=True)
+    # Orden medallero: puntos → 1º → 2º → 3º → nombre
+    table.sort(key=lambda x: (-x["points"], -x["wins"], -x["seconds"], -x["thirds"], x["name"]))
 
     # Posición (empatada si coinciden todos los criterios)
-    last_key = None
-    current_pos = 0
-    for i, t in enumerate(table, start=1):
-        key = (t["points"], t["wins"], t["seconds"], t["thirds"])
-        if key != last_key:
-            current_pos = i
-            last_key = key
-        t["pos"] = current_pos
-
-    # Sección de participación para mostrar jugadas/pedientes
-    participation = []
-    for pid in ids:
-        r = per_player[pid]
-        participation.append({
-            "name": r["name"],
-            "played": r["played"],
-            "remaining": r["remaining"],
-            "rests": r["rests"],
-            "planned_to_play": r["planned_to_play"],
-        })
-    participation.sort(key=lambda x: x["name"])
-
-    return render_template(
-        "index.html",
-        table=table,
-        participation=participation,
-        total_rounds=total_rounds,
-        is_admin=session.get("is_admin", False)
-    )
+    pos = 1
+    for _, tied in groupby(table, key=lambda x: (x["points"], x["wins"], x["seconds"], x["thirds"])):
+        tied = list(tied)
+        for t in tied:
+            t["pos"] = pos
+        pos += len(tied)
+
+    return table, participation, total_rounds
+
+@app.route("/")
+def index():
+    is_admin = session.get("is_admin", False)
+    version = tournament_version()
+    # Con mensajes flash pendientes la página no es reutilizable: se genera sin ETag
+    etag = None if "_flashes" in session else f"{version}-{int(is_admin)}"
+    if etag and request.if_none_match.contains_weak(etag):
+        resp = make_response("", 304)
+    else:
+        table, participation, total_rounds = classification_data(version)
+        resp = make_response(render_template(
+            "index.html",
+            table=table,
+            participation=participation,
+            total_rounds=total_rounds,
+            is_admin=is_admin
+        ))
+    if etag:
+        resp.set_etag(etag, weak=True)
+        resp.cache_control.no_cache = True  # el navegador revalida siempre
+    return resp
 
 # ---------- PÁGINA DE RONDAS ----------
 @app.route("/rounds")
 def rounds_view():
     players_all = Player.query.filter_by(active=True).order_by(Player.name.asc()).all()
-    bye_by_round = {ri.number: (ri.bye_player.name if ri.bye_player else None,
-                                ri.bye_player_id if ri.bye_player_id else None)
-                    for ri in RoundInfo.query.all()}
+    names = dict(db.session.query(Player.id, Player.name).all())  # incluye inactivos
+    bye_by_round = {number: (names.get(bye_id), bye_id or None)
+                    for number, bye_id in db.session.query(RoundInfo.number, RoundInfo.bye_player_id)}
 
     rounds = {}
-    games = Game.query.order_by(Game.round_number.asc(), Game.table_no.asc()).all()
+    games = (Game.query
+             .options(selectinload(Game.results))
+             .order_by(Game.round_number.asc(), Game.table_no.asc())
+             .all())
     for g in games:
         participants = []
         for r in sorted(g.results, key=lambda x: (x.position or 9999)):
-            participants.append({"name": r.player.name, "pos": r.position})
-
-        winner = next((r.player.name for r in g.results if r.position == 1), None)
-        second = next((r.player.name for r in g.results if r.position == 2), None)
-        third  = next((r.player.name for r in g.results if r.position == 3), None)
+            participants.append({"name": names[r.player_id], "pos": r.position})
 
-        # ¿Esta mesa tiene ganador? (cualquier r.position==1 o g.sweep marcado)
-        has_winner = any(r.position == 1 for r in g.results) or bool(g.sweep)
+        winner = next((names[r.player_id] for r in g.results if r.position == 1), None)
+        second = next((names[r.player_id] for r in g.results if r.position == 2), None)
+        third  = next((names[r.player_id] for r in g.results if r.position == 3), None)
 
         bye_name, bye_id = bye_by_round.get(g.round_number, (None, None))
         rounds.setdefault(g.round_number, {"bye": bye_name, "bye_id": bye_id, "games": []})
@@ -361,8 +505,8 @@ def rounds_view():
             "third": third,
             "banned": g.banned_card,
             "sweep": g.sweep,
-            "save": (g.save_player.name if g.save_player else None),  # Salvavidas
-            "played": has_winner
+            "save": names.get(g.save_player_id),  # Salvavidas
+            "played": g.has_winner
         })
 
     ordered = []
@@ -377,29 +521,23 @@ def rounds_view():
                            is_admin=session.get("is_admin", False))
 
 @app.route("/rounds/<int:round_no>/bye", methods=["POST"])
+@admin_required
 def round_set_bye(round_no):
-    if not session.get("is_admin"):
-        flash("No autorizado.", "danger")
-        return redirect(url_for("rounds_view"))
-
     bye_pid = request.form.get("bye_player_id")
     bye_pid = int(bye_pid) if bye_pid and bye_pid != "none" else None
 
-    ri = RoundInfo.query.filter_by(number=round_no).first()
+    ri = RoundInfo.query.options(load_only(RoundInfo.id)).filter_by(number=round_no).first()
     if not ri:
         ri = RoundInfo(number=round_no)
         db.session.add(ri)
     ri.bye_player_id = bye_pid
-    db.session.commit()
+    commit_changes()
     flash(f"Descanso de la ronda {round_no} actualizado.", "success")
     return redirect(url_for("rounds_view"))
 
 @app.route("/games/<int:game_id>/edit", methods=["GET", "POST"])
+@admin_required
 def game_edit(game_id):
-    if not session.get("is_admin"):
-        flash("No autorizado.", "danger")
-        return redirect(url_for("index"))
-
     g = Game.query.get_or_404(game_id)
     # Participantes = los que tienen GameResult en esa mesa
     results = GameResult.query.filter_by(game_id=game_id).all()
@@ -466,8 +604,9 @@ def game_edit(game_id):
                     r.position = 2
                 if third_id and r.player_id == third_id:
                     r.position = 3
+        g.has_winner = sweep or any(r.position == 1 for r in results)
 
-        db.session.commit()
+        commit_changes()
         flash("Partida actualizada.", "success")
         return redirect(url_for("rounds_view"))
 
@@ -485,85 +624,71 @@ def game_edit(game_id):
 # === Acciones sobre mesas (admin) === Limpiar, borrar, limpiar ronda, reiniciar torneo
 
 @app.route("/games/<int:game_id>/reset", methods=["POST"])
+@admin_required
 def game_reset(game_id):
-    if not session.get("is_admin"):
-        flash("No autorizado.", "danger")
-        return redirect(url_for("rounds_view"))
-
     g = Game.query.get_or_404(game_id)
 
     # Limpiar campos de la partida
     g.banned_card = None
     g.sweep = False
+    g.has_winner = False
     g.save_player_id = None
 
     # Poner posiciones en blanco (None) para todos los participantes
     for r in g.results:
         r.position = None
 
-    db.session.commit()
+    commit_changes()
     flash(f"Ronda {g.round_number} Mesa {g.table_no} vaciada.", "success")
     return redirect(url_for("rounds_view"))
 
 
 @app.route("/games/<int:game_id>/delete", methods=["POST"])
+@admin_required
 def game_delete(game_id):
-    if not session.get("is_admin"):
-        flash("No autorizado.", "danger")
-        return redirect(url_for("rounds_view"))
-
     g = Game.query.get_or_404(game_id)
     rn, tn = g.round_number, g.table_no
-    # Al borrar Game, sus GameResult se eliminan por el cascade="all, delete-orphan"
+    # Al borrar Game, SQLite elimina sus GameResult (ON DELETE CASCADE) sin cargarlos aquí
     db.session.delete(g)
-    db.session.commit()
+    commit_changes()
     flash(f"Ronda {rn} Mesa {tn} eliminada.", "success")
     return redirect(url_for("rounds_view"))
 
 
 @app.route("/rounds/<int:round_no>/clear", methods=["POST"])
+@admin_required
 def round_clear(round_no):
     """Vacía ambas mesas de la ronda (si existen) y mantiene el descanso."""
-    if not session.get("is_admin"):
-        flash("No autorizado.", "danger")
-        return redirect(url_for("rounds_view"))
-
     games = Game.query.filter_by(round_number=round_no).all()
     for g in games:
         g.banned_card = None
         g.sweep = False
+        g.has_winner = False
         g.save_player_id = None
         for r in g.results:
             r.position = None
-    db.session.commit()
+    commit_changes()
     flash(f"Ronda {round_no}: mesas vaciadas (se mantiene el descanso).", "success")
     return redirect(url_for("rounds_view"))
 
 
 @app.route("/admin/reset_tournament", methods=["POST"])
+@admin_required
 def reset_tournament():
     """Elimina todas las rondas y mesas, manteniendo los jugadores."""
-    if not session.get("is_admin"):
-        flash("No autorizado.", "danger")
-        return redirect(url_for("rounds_view"))
-
-    # Borrar via ORM para respetar cascade en Game.results
-    for g in Game.query.all():
-        db.session.delete(g)
-    for ri in RoundInfo.query.all():
-        db.session.delete(ri)
-    db.session.commit()
+    # Borrado en bloque: primero los resultados (hijos) y luego mesas y descansos
+    db.session.execute(GameResult.__table__.delete())
+    db.session.execute(Game.__table__.delete())
+    db.session.execute(RoundInfo.__table__.delete())
+    commit_changes()
     flash("Torneo reiniciado: se borraron todas las mesas y descansos. Jugadores conservados.", "warning")
     return redirect(url_for("rounds_view"))
 
 # ========== ADMIN: Gestión de jugadores ==========
 
 @app.route("/admin/players")
+@admin_required
 def players_admin():
-    if not session.get("is_admin"):
-        flash("No autorizado.", "danger")
-        return redirect(url_for("index"))
-
     from sqlalchemy import func
     q_counts = (db.session.query(GameResult.player_id, func.count(GameResult.id))
                 .group_by(GameResult.player_id).all())
@@ -572,31 +697,29 @@ def players_admin():
     return render_template("players.html", players=players, counts=counts)
 
 @app.route("/admin/players/add", methods=["POST"])
+@admin_required
 def player_add():
-    if not session.get("is_admin"):
-        flash("No autorizado.", "danger")
-        return redirect(url_for("index"))
     name = (request.form.get("name") or "").strip()
     if not name:
         flash("El nombre no puede estar vacío.", "warning")
         return redirect(url_for("players_admin"))
-    exists = Player.query.filter(db.func.lower(Player.name) == name.lower()).first()
-    if exists:
+    # La unicidad (sin distinguir mayúsculas) la garantiza el índice ix_player_name_lower
+    db.session.add(Player(name=name, active=True))
+    try:
+        commit_changes()
+    except IntegrityError:
+        db.session.rollback()
         flash(f"Ya existe un jugador llamado '{name}'.", "warning")
         return redirect(url_for("players_admin"))
-    db.session.add(Player(name=name, active=True))
-    db.session.commit()
     flash(f"Jugador '{name}' agregado (activo).", "success")
     return redirect(url_for("players_admin"))
 
 @app.route("/admin/players/<int:pid>/toggle", methods=["POST"])
+@admin_required
 def player_toggle(pid):
-    if not session.get("is_admin"):
-        flash("No autorizado.", "danger")
-        return redirect(url_for("index"))
     p = Player.query.get_or_404(pid)
     p.active = not p.active
-    db.session.commit()
+    commit_changes()
     flash(f"Jugador '{p.name}' ahora está {'activo' if p.active else 'inactivo'}.", "info")
     return redirect(url_for("players_admin"))
 
@@ -604,43 +727,34 @@ def player_toggle(pid):
 # ========== ADMIN: Rondas (crear / eliminar) ==========
 
 @app.route("/rounds/add", methods=["POST"])
+@admin_required
 def round_add():
-    if not session.get("is_admin"):
-        flash("No autorizado.", "danger")
-        return redirect(url_for("rounds_view"))
-
-    # próximo número = max(número en RoundInfo, número en Game) + 1
-    max_ri = db.session.query(db.func.max(RoundInfo.number)).scalar() or 0
-    max_g  = db.session.query(db.func.max(Game.round_number)).scalar() or 0
-    next_no = max(max_ri, max_g) + 1
+    # próximo número = max(número en RoundInfo, número en Game) + 1, en una sola consulta
+    next_no = db.session.execute(text(
+        "SELECT COALESCE(MAX(n), 0) + 1 FROM "
+        "(SELECT number AS n FROM round_info UNION ALL SELECT round_number FROM game)"
+    )).scalar()
 
     ri = RoundInfo(number=next_no)
     db.session.add(ri)
-    db.session.commit()
+    commit_changes()
     flash(f"Ronda {next_no} creada (vacía). Usa 'Editar mesas' para asignar jugadores.", "success")
     return redirect(url_for("rounds_view"))
 
 
 @app.route("/rounds/<int:round_no>/delete", methods=["POST"])
+@admin_required
 def round_delete(round_no):
-    if not session.get("is_admin"):
-        flash("No autorizado.", "danger")
-        return redirect(url_for("rounds_view"))
-
-    # Borra todas las mesas de la ronda (con sus resultados) y el RoundInfo
-    games = Game.query.filter_by(round_number=round_no).all()
-    for g in games:
-        db.session.delete(g)  # cascade elimina GameResult
-    ri = RoundInfo.query.filter_by(number=round_no).first()
-    if ri:
-        db.session.delete(ri)
-    db.session.commit()
+    # Borra todas las mesas de la ronda (sus resultados caen por ON DELETE CASCADE) y el RoundInfo
+    db.session.execute(Game.__table__.delete().where(Game.round_number == round_no))
+    db.session.execute(RoundInfo.__table__.delete().where(RoundInfo.number == round_no))
+    commit_changes()
     flash(f"Ronda {round_no} eliminada por completo.", "warning")
     return redirect(url_for("rounds_view"))
 
 # --- util ---
 def get_or_create_game(round_no: int, table_no: int) -> Game:
-    g = Game.query.filter_by(round_number=round_no, table_no=table_no).first()
+    g = Game.query.options(load_only(Game.id)).filter_by(round_number=round_no, table_no=table_no).first()
     if not g:
         g = Game(round_number=round_no, table_no=table_no)
         db.session.add(g)
@@ -648,12 +762,8 @@ def get_or_create_game(round_no: int, table_no: int) -> Game:
     return g
 
 @app.route("/rounds/<int:round_no>/edit", methods=["GET", "POST"])
+@admin_required
 def round_edit(round_no):
-    # Solo admin edita
-    if not session.get("is_admin"):
-        flash("No autorizado.", "danger")
-        return redirect(url_for("rounds_view"))
-
     players = Player.query.filter_by(active=True).order_by(Player.name.asc()).all()
     all_ids = [p.id for p in players]
 
@@ -706,15 +816,16 @@ def round_edit(round_no):
         g1 = get_or_create_game(round_no, 1)
         g2 = get_or_create_game(round_no, 2)
 
-        # borro resultados actuales y creo los nuevos (posiciones en None)
+        # borro resultados actuales y creo los nuevos (posiciones en None: solo cuenta la barrida)
+        g1.has_winner = bool(g1.sweep)
+        g2.has_winner = bool(g2.sweep)
         GameResult.query.filter_by(game_id=g1.id).delete(synchronize_session=False)
         GameResult.query.filter_by(game_id=g2.id).delete(synchronize_session=False)
-        for pid in sorted(t1_new):
-            db.session.add(GameResult(game_id=g1.id, player_id=pid, position=None))
-        for pid in sorted(t2_new):
-            db.session.add(GameResult(game_id=g2.id, player_id=pid, position=None))
+        db.session.execute(insert(GameResult.__table__),
+                           [{"game_id": g1.id, "player_id": pid, "position": None} for pid in sorted(t1_new)] +
+                           [{"game_id": g2.id, "player_id": pid, "position": None} for pid in sorted(t2_new)])
 
-        db.session.commit()
+        commit_changes()
         flash(f"Ronda {round_no}: mesas y descanso actualizados.", "success")
         return redirect(url_for("rounds_view"))
 
@@ -757,6 +868,14 @@ def init_db_and_import():
             seed_players()
         import_initial_rounds()
 
+# Al importar (también bajo WSGI): crea 'leaderboard' y 'tournament_state' si faltan
+# y sincroniza la clasificación con los datos actuales
+with app.app_context():
+    Leaderboard.__table__.create(db.engine, checkfirst=True)
+    TournamentState.__table__.create(db.engine, checkfirst=True)
+    db.session.execute(text("INSERT OR IGNORE INTO tournament_state (id, version) VALUES (1, 0)"))
+    commit_changes()
+
 if __name__ == "__main__":
     init_db_and_import()
     app.run(debug=True)  # http://127.0.0.1:5000